@@ -0,0 +1,163 @@
+# Copyright 2026 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import socket
+import time
+import uuid
+
+from hamcrest.core.matcher import Matcher
+from kombu import Connection, Consumer, Exchange, Queue
+
+DEFAULT_CONNECTION_FIELDS = {
+    'username': 'guest',
+    'password': 'guest',
+    'host': 'localhost',
+    'port': 5672,
+}
+
+
+class BusClient:
+
+    @classmethod
+    def from_connection_fields(cls, exchange_name='xivo', exchange_type='topic', **kwargs):
+        fields = dict(DEFAULT_CONNECTION_FIELDS, **kwargs)
+        url = 'amqp://{username}:{password}@{host}:{port}//'.format(**fields)
+        return cls(url, Exchange(exchange_name, type=exchange_type))
+
+    def __init__(self, url, exchange):
+        self._url = url
+        self._exchange = exchange
+        self._connection = None
+        self._accumulators = []
+
+    def accumulator(self, routing_key):
+        if not self._connection:
+            # kombu uses the librabbitmq C client for amqp:// URLs when it is installed
+            # and falls back to pyamqp otherwise
+            self._connection = Connection(self._url)
+        channel = self._connection.channel()
+        queue = Queue(
+            name='test-{}'.format(uuid.uuid4()),
+            exchange=self._exchange,
+            routing_key=routing_key,
+            channel=channel,
+            durable=False,
+            exclusive=True,
+            auto_delete=True,
+        )
+        accumulator = BusMessageAccumulator(self._connection, channel, queue)
+        self._accumulators.append(accumulator)
+        return accumulator
+
+    def receive_for(self, duration):
+        """Receive the messages of every accumulator for `duration` seconds.
+
+        The accumulators share one connection, so a single quiet period covers
+        all of them.
+        """
+        if self._connection:
+            _drain_until(self._connection, time.monotonic() + duration)
+
+    def close_accumulators(self):
+        for accumulator in self._accumulators:
+            accumulator.close()
+        self._accumulators = []
+
+    def close(self):
+        self.close_accumulators()
+        if self._connection:
+            self._connection.release()
+            self._connection = None
+
+
+class BusMessageAccumulator:
+
+    def __init__(self, connection, channel, queue):
+        self._connection = connection
+        self._channel = channel
+        self._events = []
+        self._new_events_index = 0
+        # no acknowledgements: the broker pushes messages without waiting for acks
+        self._consumer = Consumer(channel, queues=[queue], callbacks=[self._on_message], no_ack=True)
+        self._consumer.consume()
+
+    def accumulate_new(self):
+        """Return the events received since the previous call to accumulate_new."""
+        self._drain_pending()
+        new_events = self._events[self._new_events_index:]
+        self._new_events_index = len(self._events)
+        return new_events
+
+    def wait_for(self, matcher, min_count=1, timeout=5):
+        """Block until `min_count` events matching `matcher` are received and return them.
+
+        `matcher` is either a hamcrest matcher or a plain predicate taking an event;
+        a predicate avoids the matcher dispatch overhead on busy accumulators. Its
+        str() describes it in failure messages, so give predicates a readable repr.
+
+        Messages are dispatched as soon as they reach the connection, instead of
+        being checked at a fixed polling interval. Each event is matched only
+        once, when it is received.
+        """
+        matches = matcher.matches if isinstance(matcher, Matcher) else matcher
+        deadline = time.monotonic() + timeout
+        matched = []
+        checked = 0
+        while True:
+            for event in self._events[checked:]:
+                if matches(event):
+                    matched.append(event)
+            checked = len(self._events)
+            if len(matched) >= min_count:
+                break
+
+            if time.monotonic() >= deadline:
+                raise AssertionError(
+                    'Expected {} event(s) matching {} within {}s, got {}: {}'.format(
+                        min_count, matcher, timeout, len(matched), self._events,
+                    )
+                )
+            _drain_until(self._connection, deadline, stop_on_message=True)
+
+        return matched
+
+    def assert_only(self, matcher):
+        """Check that every event received so far matches `matcher`.
+
+        Use BusClient.receive_for first to give unexpected events time to arrive.
+        """
+        matches = matcher.matches if isinstance(matcher, Matcher) else matcher
+        unexpected = [event for event in self._events if not matches(event)]
+        if unexpected:
+            raise AssertionError(
+                'Expected only events matching {}, got unexpected events: {}'.format(
+                    matcher, unexpected,
+                )
+            )
+
+    def close(self):
+        self._consumer.cancel()
+        self._channel.close()
+
+    def _drain_pending(self, idle_timeout=0.1):
+        while True:
+            try:
+                self._connection.drain_events(timeout=idle_timeout)
+            except socket.timeout:
+                return
+
+    def _on_message(self, body, message):
+        self._events.append(body)
+
+
+def _drain_until(connection, deadline, stop_on_message=False):
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        try:
+            connection.drain_events(timeout=remaining)
+        except socket.timeout:
+            return
+        if stop_on_message:
+            return
@@ -5,21 +5,21 @@ import ari as ari_client
 import logging
 import os
 import pytest
+import time
+from concurrent.futures import ThreadPoolExecutor
 from hamcrest import (
     assert_that,
     calling,
     empty,
-    has_entry,
-    has_item,
-    is_not,
     not_,
-    only_contains,
 )
+from requests.exceptions import HTTPError
 from xivo_test_helpers import until
-from xivo_test_helpers.bus import BusClient
-from xivo_test_helpers.asset_launching_test_case import AssetLaunchingTestCase
+from xivo_test_helpers.asset_launching_test_case import AssetLaunchingTestCase, _run_cmd
 from xivo_test_helpers.hamcrest.raises import raises
 
+from helpers.bus import BusClient
+
 log_level = logging.DEBUG if os.environ.get('TEST_LOGS') == 'verbose' else logging.INFO
 logging.basicConfig(level=log_level)
 
@@ -27,6 +27,9 @@ app_name_key = 'applicationName'
 
 subscribe_args = {app_name_key: 'newstasisapplication'}
 
+# time given to unexpected events to arrive before checking there are none
+QUIET_PERIOD = 0.5
+
 
 class AssetLauncher(AssetLaunchingTestCase):
 
@@ -34,87 +37,157 @@ class AssetLauncher(AssetLaunchingTestCase):
     asset = 'amqp'
     service = 'ari_amqp'
 
+    @classmethod
+    def down_containers(cls):
+        # one docker-compose call instead of kill + rm, without the stop grace period;
+        # run like kill_containers and rm_containers, with the output logged
+        _run_cmd(
+            ['docker-compose']
+            + cls._docker_compose_options()
+            + ['down', '--timeout', '0', '--volumes', '--remove-orphans'],
+            stderr=False,
+        )
 
-@pytest.fixture()
-def ari():
-    AssetLauncher.kill_containers()
-    AssetLauncher.rm_containers()
-    AssetLauncher.launch_service_with_asset()
-    ari_url = 'http://127.0.0.1:{port}'.format(port=AssetLauncher.service_port(5039, 'ari_amqp'))
-    client = until.return_(ari_client.connect, ari_url, 'wazo', 'wazo', timeout=5, interval=0.1)
 
-    # necessary because RabbitMQ starts much more slowly, so module fails to load automatically
-    AssetLauncher.docker_exec(
-        ['asterisk', '-rx', 'module load res_stasis_amqp.so'], service_name='ari_amqp',
-    )
-    AssetLauncher.docker_exec(
-        ['asterisk', '-rx', 'module load res_ari_amqp.so'], service_name='ari_amqp',
-    )
+def return_with_backoff(func, *args, timeout=5, interval=0.02, max_interval=0.2, factor=1.5):
+    # like until.return_, but retries quickly first and backs off exponentially
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return func(*args)
+        except Exception:
+            if time.monotonic() + interval > deadline:
+                raise
+        time.sleep(interval)
+        interval = min(interval * factor, max_interval)
 
-    yield client
-    AssetLauncher.kill_containers()
 
+def stasis_app_routing_key(app):
+    # res_stasis_amqp lower-cases the application name in the routing key
+    return 'stasis.app.' + app.lower()
 
-def test_stasis_amqp_events(ari):
-    real_app = 'A'
-    parasite_app = 'B'
-    ari.amqp.stasisSubscribe(applicationName=real_app)
-    ari.amqp.stasisSubscribe(applicationName=parasite_app)
 
-    assert_that(ari.applications.list(), has_item(has_entry('name', real_app)))
-    assert_that(ari.applications.list(), has_item(has_entry('name', parasite_app)))
+class StasisAppEvent:
+    # plain predicate for BusMessageAccumulator, with a readable failure description
 
-    bus_client = BusClient.from_connection_fields(port=AssetLauncher.service_port(5672, 'rabbitmq'))
+    def __init__(self, app):
+        self.app = app
 
-    assert bus_client.is_up()
+    def __call__(self, event):
+        return event.get('application') == self.app
 
-    events = bus_client.accumulator("stasis.app." + real_app.lower())
-    parasite_events = bus_client.accumulator("stasis.app." + parasite_app.lower())
+    def __repr__(self):
+        return 'an event of application {!r}'.format(self.app)
 
-    ari.channels.originate(endpoint='local/3000@default', app=real_app)
-    ari.channels.originate(endpoint='local/3000@default', app=parasite_app)
 
-    def event_received(events, app):
-        assert_that(events.accumulate(), only_contains(
-            has_entry('application', app)
-        ))
+class OtherStasisAppEvent(StasisAppEvent):
 
-        assert_that(parasite_events.accumulate(), only_contains(
-            has_entry('application', is_not(app))
-        ))
+    def __call__(self, event):
+        return not super().__call__(event)
 
-    until.assert_(event_received, events, real_app, timeout=5)
+    def __repr__(self):
+        return 'an event of an application other than {!r}'.format(self.app)
 
-    def event_received(events, app):
-        assert_that(events.accumulate(), only_contains(
-            has_entry('application', app)
-        ))
 
-        assert_that(parasite_events.accumulate(), only_contains(
-            has_entry('application', is_not(app))
-        ))
+def app_exists(ari, name):
+    try:
+        ari.applications.get(applicationName=name)
+    except HTTPError as e:
+        if e.response.status_code == 404:
+            return False
+        raise
+    return True
 
-    until.assert_(event_received, events, real_app, timeout=5)
 
+@pytest.fixture(scope='session')
+def ari():
+    AssetLauncher.down_containers()
+    AssetLauncher.launch_service_with_asset()
+    ari_url = 'http://127.0.0.1:{port}'.format(port=AssetLauncher.service_port(5039, 'ari_amqp'))
+    client = return_with_backoff(ari_client.connect, ari_url, 'wazo', 'wazo', timeout=5)
 
-def test_stasis_amqp_events_bad_routing(ari):
-    real_app = 'A'
-    parasite_app = 'B'
-    ari.amqp.stasisSubscribe(applicationName=real_app)
-    ari.amqp.stasisSubscribe(applicationName=parasite_app)
+    yield client
+    AssetLauncher.down_containers()
 
-    bus_client = BusClient.from_connection_fields(port=AssetLauncher.service_port(5672, 'rabbitmq'))
 
-    assert bus_client.is_up()
+@pytest.fixture(autouse=True)
+def reset_channels(ari):
+    # the stack is shared by all tests: hang up leftover channels so their events
+    # do not leak into the accumulators of the next test
+    yield
+    for channel in ari.channels.list():
+        try:
+            channel.hangup()
+        except HTTPError as e:
+            if e.response.status_code != 404:
+                raise
 
-    events = bus_client.accumulator("stasis.app." + parasite_app.lower())
+    no_channels = empty()
+
+    def no_channels_left():
+        assert_that(ari.channels.list(), no_channels)
+
+    until.assert_(no_channels_left, timeout=5)
+
+
+@pytest.fixture(scope='session')
+def bus_clients(ari):
+    clients = {}
+
+    def get_bus_client(exchange_name='xivo', exchange_type='topic'):
+        key = (exchange_name, exchange_type)
+        if key not in clients:
+            clients[key] = BusClient.from_connection_fields(
+                port=AssetLauncher.service_port(5672, 'rabbitmq'),
+                exchange_name=exchange_name,
+                exchange_type=exchange_type,
+            )
+        return clients[key]
+
+    yield get_bus_client
+    for client in clients.values():
+        client.close()
 
-    ari.channels.originate(endpoint='local/3000@default', app=real_app.lower())
 
-    def event_received(events, app):
-        assert_that(events.accumulate(), empty())
+@pytest.fixture()
+def bus_client(bus_clients):
+    client = bus_clients()
+    yield client
+    client.close_accumulators()
+
+
+def test_stasis_amqp_events(ari, bus_client):
+    real_app = 'A'
+    parasite_app = 'B'
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda app: ari.amqp.stasisSubscribe(applicationName=app), (real_app, parasite_app)))
+
+    events = bus_client.accumulator(stasis_app_routing_key(real_app))
+    parasite_events = bus_client.accumulator(stasis_app_routing_key(parasite_app))
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        originates = [
+            executor.submit(ari.channels.originate, endpoint='local/3000@default', app=app)
+            for app in (real_app, parasite_app)
+        ]
+    for originate in originates:
+        originate.result()
+
+    real_app_event = StasisAppEvent(real_app)
+    other_app_event = OtherStasisAppEvent(real_app)
+    events.wait_for(real_app_event, timeout=5)
+    parasite_events.wait_for(other_app_event, timeout=5)
+    # one quiet period for both accumulators, then check nothing was misrouted
+    bus_client.receive_for(QUIET_PERIOD)
+    events.assert_only(real_app_event)
+    parasite_events.assert_only(other_app_event)
+
+    parasite_events.accumulate_new()
+    ari.channels.originate(endpoint='local/3000@default', app=real_app.lower())
 
-    until.assert_(event_received, events, subscribe_args[app_name_key], timeout=5)
+    # the events of that call are published and delivered well within the quiet period
+    bus_client.receive_for(QUIET_PERIOD)
+    assert_that(parasite_events.accumulate_new(), empty())
 
 
 def test_app_subscribe(ari):
@@ -123,7 +196,7 @@ def test_app_subscribe(ari):
         not_(raises(Exception))
     )
 
-    assert_that(ari.applications.list(), has_item(has_entry('name', subscribe_args[app_name_key])))
+    assert app_exists(ari, subscribe_args[app_name_key])
 
 
 @pytest.mark.skip(reason='not implemented')
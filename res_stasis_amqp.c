@@ -35,6 +35,14 @@
 /*** DOCUMENTATION
 	<configInfo name="res_stasis_amqp" language="en_US">
 		<synopsis>Stasis to AMQP Backend</synopsis>
+		<description>
+			<para>Events are queued and published by a dedicated thread, so Asterisk
+			never waits for the broker while handling calls.</para>
+			<para>At most 10000 events are kept waiting. When the broker is unreachable
+			or cannot keep up, newer events are dropped instead of blocking Asterisk.
+			A warning is logged when events start being dropped, and another one with the
+			number of dropped events once the queue accepts events again.</para>
+		</description>
 		<configFile name="stasis_amqp.conf">
 			<configObject name="global">
 				<synopsis>Global configuration settings</synopsis>
@@ -83,11 +91,18 @@
 #include "asterisk/manager.h"
 #include "asterisk/json.h"
 #include "asterisk/utils.h"
+#include "asterisk/lock.h"
+#include "asterisk/linkedlists.h"
 
 #include "asterisk/amqp.h"
 
 #define CONF_FILENAME "stasis_amqp.conf"
 #define ROUTING_KEY_LEN 256
+/*!
+ * Maximum number of messages waiting for the publishing thread. Past this,
+ * new messages are dropped rather than blocking the Stasis threads on the broker.
+ */
+#define PUBLISH_QUEUE_MAX_LEN 10000
 
 /*!
  * The ast_sched_context used for stasis application polling
@@ -105,6 +120,7 @@ void destroy_app(void *obj);
 static int setup_amqp(void);
 static int stasis_amqp_channel_log(struct stasis_message *message);
 static int publish_to_amqp(const char *topic, const char *name, const struct ast_eid *eid, struct ast_json *body);
+static int enqueue_amqp_message(const char *routing_key, char *body);
 int register_to_new_stasis_app(const void *data);
 char *new_routing_key(const char *prefix, const char *suffix);
 struct ast_eid *eid_copy(const struct ast_eid *eid);
@@ -132,6 +148,25 @@ struct stasis_amqp_global_conf {
 	);
 };
 
+/*! \brief A message waiting to be published by the publishing thread */
+struct amqp_message {
+	char *routing_key;
+	char *body;
+	AST_LIST_ENTRY(amqp_message) list;
+};
+
+AST_LIST_HEAD_NOLOCK(amqp_message_list, amqp_message);
+
+/*! \brief Messages waiting to be published, protected by publish_lock */
+static struct amqp_message_list publish_queue = AST_LIST_HEAD_NOLOCK_INIT_VALUE;
+static size_t publish_queue_len;
+/*! \brief Messages dropped since the queue last overflowed, protected by publish_lock */
+static unsigned int publish_dropped;
+static int publish_thread_stop;
+AST_MUTEX_DEFINE_STATIC(publish_lock);
+static ast_cond_t publish_cond;
+static pthread_t publish_thread = AST_PTHREADT_NULL;
+
 /*! \brief Locking container for safe configuration access. */
 static AO2_GLOBAL_OBJ_STATIC(confs);
 
@@ -461,14 +496,12 @@ struct ast_eid *eid_copy(const struct ast_eid *eid)
 
 static int publish_to_amqp(const char *topic, const char *name, const struct ast_eid *eid, struct ast_json *body)
 {
-	RAII_VAR(struct stasis_amqp_conf *, conf, NULL, ao2_cleanup);
 	RAII_VAR(char *, msg, NULL, ast_json_free);
 	RAII_VAR(struct ast_json *, json_msg, NULL, ast_json_free);
 	RAII_VAR(struct ast_json *, json_name, NULL, ast_json_unref);
 	RAII_VAR(struct ast_json *, json_eid, NULL, ast_json_unref);
 	RAII_VAR(struct ast_eid *, message_eid, NULL, ast_free);
 	char eid_str[128];
-	int res;
 
 	message_eid = eid_copy(eid != NULL ? eid : &ast_eid_default);
 	ast_eid_to_str(eid_str, sizeof(eid_str), message_eid);
@@ -515,6 +548,87 @@ static int publish_to_amqp(const char *topic, const char *name, const struct ast
 		}
 	}
 
+	if (enqueue_amqp_message(topic, msg)) {
+		return -1;
+	}
+	/* the body is now owned by the publishing queue */
+	msg = NULL;
+
+	return 0;
+}
+
+static void amqp_message_destroy(struct amqp_message *message)
+{
+	ast_free(message->routing_key);
+	ast_json_free(message->body);
+	ast_free(message);
+}
+
+/*!
+ * \brief Queue a message for the publishing thread.
+ *
+ * \param routing_key Routing key of the message; it is copied.
+ * \param body JSON body allocated by ast_json_dump_string; ownership is taken on success.
+ * \return 0 on success.
+ * \return -1 on error.
+ */
+static int enqueue_amqp_message(const char *routing_key, char *body)
+{
+	struct amqp_message *message;
+	unsigned int dropped;
+
+	if (!(message = ast_calloc(1, sizeof(*message)))) {
+		ast_log(LOG_ERROR, "failed to allocate an AMQP message\n");
+		return -1;
+	}
+
+	if (!(message->routing_key = ast_strdup(routing_key))) {
+		ast_log(LOG_ERROR, "failed to copy the AMQP routing key\n");
+		ast_free(message);
+		return -1;
+	}
+
+	ast_mutex_lock(&publish_lock);
+	if (publish_thread_stop) {
+		ast_mutex_unlock(&publish_lock);
+		ast_free(message->routing_key);
+		ast_free(message);
+		return -1;
+	}
+	if (publish_queue_len >= PUBLISH_QUEUE_MAX_LEN) {
+		dropped = ++publish_dropped;
+		ast_mutex_unlock(&publish_lock);
+		/* warn once per overflow, the count is reported when the queue drains */
+		if (dropped == 1) {
+			ast_log(LOG_WARNING, "AMQP publish queue is full (%d messages), dropping messages\n",
+				PUBLISH_QUEUE_MAX_LEN);
+		}
+		ast_free(message->routing_key);
+		ast_free(message);
+		return -1;
+	}
+	dropped = publish_dropped;
+	publish_dropped = 0;
+	message->body = body;
+	AST_LIST_INSERT_TAIL(&publish_queue, message, list);
+	publish_queue_len++;
+	ast_cond_signal(&publish_cond);
+	ast_mutex_unlock(&publish_lock);
+
+	if (dropped) {
+		ast_log(LOG_WARNING, "AMQP publish queue is accepting messages again, %u were dropped\n", dropped);
+	}
+
+	return 0;
+}
+
+static void publish_messages(struct amqp_message_list *messages)
+{
+	RAII_VAR(struct stasis_amqp_conf *, conf, NULL, ao2_cleanup);
+	struct ast_amqp_connection *amqp = NULL;
+	struct amqp_message *message;
+	int res;
+
 	amqp_basic_properties_t props = {
 		._flags = AMQP_BASIC_DELIVERY_MODE_FLAG | AMQP_BASIC_CONTENT_TYPE_FLAG,
 		.delivery_mode = 2, /* persistent delivery mode */
@@ -523,31 +637,99 @@ static int publish_to_amqp(const char *topic, const char *name, const struct ast
 
 	conf = ao2_global_obj_ref(confs);
 
-
 	ast_assert(conf && conf->global && conf->global->connection);
 
-	struct ast_amqp_connection *amqp = ast_amqp_get_connection(conf->global->connection);
+	/* a single connection lookup for all the messages taken from the queue */
+	amqp = ast_amqp_get_connection(conf->global->connection);
 	if (!amqp) {
 		ast_log(LOG_ERROR, "Failed to get an AMQP connection\n");
-		return -1;
 	}
 
-	res = ast_amqp_basic_publish(amqp,
-		amqp_cstring_bytes(conf->global->exchange),
-		amqp_cstring_bytes(topic),
-		0, /* mandatory; don't return unsendable messages */
-		0, /* immediate; allow messages to be queued */
-		&props,
-		amqp_cstring_bytes(msg));
+	while ((message = AST_LIST_REMOVE_HEAD(messages, list))) {
+		if (amqp) {
+			res = ast_amqp_basic_publish(amqp,
+				amqp_cstring_bytes(conf->global->exchange),
+				amqp_cstring_bytes(message->routing_key),
+				0, /* mandatory; don't return unsendable messages */
+				0, /* immediate; allow messages to be queued */
+				&props,
+				amqp_cstring_bytes(message->body));
 
-	if (res != 0) {
-		ast_log(LOG_ERROR, "Error publishing stasis to AMQP\n");
-		return -1;
+			if (res != 0) {
+				ast_log(LOG_ERROR, "Error publishing stasis to AMQP\n");
+			}
+		}
+		amqp_message_destroy(message);
 	}
+}
+
+/*!
+ * \brief Publishing thread.
+ *
+ * Waits for queued messages and publishes all of those waiting each time it
+ * wakes up. Messages still queued when the thread is asked to stop are
+ * published before it exits.
+ */
+static void *publish_thread_main(void *data)
+{
+	struct amqp_message_list messages = AST_LIST_HEAD_NOLOCK_INIT_VALUE;
+	size_t count;
+	int done = 0;
+
+	while (!done) {
+		ast_mutex_lock(&publish_lock);
+		while (!publish_thread_stop && AST_LIST_EMPTY(&publish_queue)) {
+			ast_cond_wait(&publish_cond, &publish_lock);
+		}
 
+		AST_LIST_APPEND_LIST(&messages, &publish_queue, list);
+		count = publish_queue_len;
+		publish_queue_len = 0;
+		done = publish_thread_stop;
+		ast_mutex_unlock(&publish_lock);
+
+		ast_debug(4, "publishing %zu AMQP messages\n", count);
+		publish_messages(&messages);
+	}
+
+	return NULL;
+}
+
+static int start_publish_thread(void)
+{
+	publish_thread_stop = 0;
+	ast_cond_init(&publish_cond, NULL);
+	if (ast_pthread_create_background(&publish_thread, NULL, publish_thread_main, NULL)) {
+		ast_log(LOG_ERROR, "failed to start the AMQP publishing thread\n");
+		ast_cond_destroy(&publish_cond);
+		publish_thread = AST_PTHREADT_NULL;
+		return -1;
+	}
 	return 0;
 }
 
+static void stop_publish_thread(void)
+{
+	if (publish_thread == AST_PTHREADT_NULL) {
+		return;
+	}
+
+	ast_mutex_lock(&publish_lock);
+	publish_thread_stop = 1;
+	ast_cond_signal(&publish_cond);
+	ast_mutex_unlock(&publish_lock);
+
+	pthread_join(publish_thread, NULL);
+	publish_thread = AST_PTHREADT_NULL;
+	ast_cond_destroy(&publish_cond);
+
+	if (publish_dropped) {
+		ast_log(LOG_WARNING, "%u AMQP messages were dropped because the publish queue was full\n",
+			publish_dropped);
+		publish_dropped = 0;
+	}
+}
+
 
 static int load_config(int reload)
 {
@@ -596,6 +778,8 @@ static int unload_module(void)
 	stasis_unsubscribe_and_join(manager);
 	sub = NULL;
 	manager = NULL;
+
+	stop_publish_thread();
 	return 0;
 }
 
@@ -662,15 +846,21 @@ static int load_module(void)
 		return AST_MODULE_LOAD_DECLINE;
 	}
 
+	if (start_publish_thread()) {
+		return AST_MODULE_LOAD_DECLINE;
+	}
+
 	/* Subscription to receive all of the messages from manager topic */
 	manager = stasis_subscribe(ast_manager_get_topic(), send_ami_event_to_amqp, NULL);
 	if (!manager) {
+		stop_publish_thread();
 		return AST_MODULE_LOAD_DECLINE;
 	}
 
 	if (!(stasis_app_sched_context = ast_sched_context_create())) {
 		ast_log(LOG_ERROR, "failed to create scheduler context\n");
 		/* unsubscribe from manager and sub */
+		stop_publish_thread();
 		return AST_MODULE_LOAD_DECLINE;
 	}
 
@@ -678,6 +868,7 @@ static int load_module(void)
 	sub = stasis_subscribe(ast_channel_topic_all(), send_channel_event_to_amqp, NULL);
 	if (!sub) {
 		/* unsubscribe from manager */
+		stop_publish_thread();
 		return AST_MODULE_LOAD_DECLINE;
 	}
 
@@ -685,6 +876,7 @@ static int load_module(void)
 		ast_log(LOG_ERROR, "failed to start scheduler thread\n");
 		/* unsubscribe from manager and sub */
 		/* destroy context */
+		stop_publish_thread();
 		return AST_MODULE_LOAD_DECLINE;
 	}
 